@@ -1,16 +1,18 @@
-import re
 import asyncio
+import concurrent.futures
+import hashlib
+import importlib.util
+import json
 import os
 import logging
-from typing import List
+import shelve
+from typing import Callable, List, MutableMapping
 from dataclasses import dataclass
 
-# rpy2 for direct R evaluation
-import rpy2.robjects as ro
-import rpy2.rinterface as rinterface
 
 # Base classes from autogen_core
 from autogen_core import (
+    CancellationToken,
     SingleThreadedAgentRuntime,
     DefaultTopicId,
     MessageContext,
@@ -29,8 +31,28 @@ from autogen_core.models import (
 
 # We'll use OpenAI as a model client
 from autogen_ext.models.openai import OpenAIChatCompletionClient
+import httpx
 import openai
 
+# Shared rpy2 session helpers (rpy2 itself is imported lazily on first use)
+from r_session import (
+    capture_r_output,
+    extract_r_code,
+    extract_r_code_blocks,
+    eval_r,
+    setup_r_session,
+    use_cached_dsc,
+)
+
+# The Assistant says this once the task is finished
+_DONE_SENTINEL = "DONE"
+
+# Set this to a file path to cache LLM responses between runs; by default nothing is cached
+_RESPONSE_CACHE_ENV = "AORTA_AGENT_RESPONSE_CACHE"
+
+# What the Executor replies when R code runs cleanly without printing anything
+_SPECULATIVE_REPLY = "SUCCESS:\n"
+
 ###############################################################################
 # A simple "Message" class representing communication between agents
 ###############################################################################
@@ -38,6 +60,34 @@ import openai
 class Message:
     content: str
 
+@dataclass
+class OutputChunk:
+    """
+    A piece of Executor console output, published while the R code is still running.
+    `run_id` identifies the run and `seq` orders the chunks within it.
+    """
+    run_id: int
+    seq: int
+    content: str
+
+@dataclass
+class OutputEnd:
+    """
+    Marks the end of Executor run `run_id`, which streamed `n_chunks` OutputChunks.
+    `status` is 'SUCCESS' or 'ERROR'; `error` holds the exception text if ro.r() itself raised.
+    """
+    run_id: int
+    n_chunks: int
+    status: str
+    error: str | None = None
+
+@dataclass
+class ExecutorFailed:
+    """
+    The Executor could not run the code at all (e.g. R failed to start), so no OutputEnd will follow.
+    """
+    error: str
+
 ###############################################################################
 # 1) The Assistant agent: writes R code in triple backticks
 ###############################################################################
@@ -49,10 +99,29 @@ class Assistant(RoutedAgent):
     # code
     ```
     Then it publishes that code to the 'Executor' agent.
+    If a `task_complete_event` is given, it is set once the model reports the task as done:
+    straight away if that answer has no R code, otherwise only after its code runs successfully.
+    If a `response_cache` is given, a chat history seen before (for the same `model_name`) is answered
+    from it without calling the model. ERROR turns and histories repeated within this session always
+    go to the model, so failing code is never replayed and a stuck loop cannot spin on cached answers.
     """
-    def __init__(self, model_client: ChatCompletionClient) -> None:
+    def __init__(
+        self,
+        model_client: ChatCompletionClient,
+        max_recent_messages: int = 8,
+        task_complete_event: asyncio.Event | None = None,
+        response_cache: MutableMapping[str, str] | None = None,
+        model_name: str = "",
+    ) -> None:
         super().__init__("Assistant Agent for R code generation.")
         self._model_client = model_client
+        self._task_complete_event = task_complete_event
+        self._response_cache = response_cache
+        self._model_name = model_name
+        # Cache keys of every history sent so far in this session
+        self._seen_history_keys: set[str] = set()
+        # Only the system prompt and this many recent messages are sent to the model
+        self._max_recent_messages = max_recent_messages
         # Keep a chat history so the model has conversation context
         self._chat_history: List[LLMMessage] = [
             SystemMessage(
@@ -65,109 +134,359 @@ class Assistant(RoutedAgent):
                     "```r\n# R code\n```\n"
                     " - If there's an error from the Executor, revise your code and try again.\n"
                     " - Summaries or explanations go outside the code block.\n"
+                    " - Prefer `data.table::fread` over `read.csv`. Compute all summary stats in a single "
+                    "`print(dt[, .(...)])` expression to avoid multiple passes over the same column.\n"
                 )
             )
         ]
+        # A completion started ahead of time for the likely next Executor reply
+        self._speculation: tuple[CancellationToken, asyncio.Task] | None = None
+        # Executor output per run_id, coalesced once the OutputEnd and all its chunks are in
+        self._executor_output: dict[int, List[OutputChunk]] = {}
+        self._executor_ends: dict[int, OutputEnd] = {}
+        # The last answer said DONE but still carried code; completion waits on that run's outcome
+        self._done_pending = False
 
     @message_handler
     async def handle_message(self, message: Message, ctx: MessageContext) -> None:
         """
-        When we receive a message (from user or from the Executor),
-        we append it as user context, call the LLM, then publish the LLM response.
+        When we receive a message from the user, we answer it.
         """
-        # The message is "user" in a conversation sense
-        self._chat_history.append(UserMessage(content=message.content, source="user"))
-        result = await self._model_client.create(self._chat_history)
+        await self._respond(message.content)
 
-        # Print the LLM's text to console
-        print("\n================= Assistant says =================\n" + result.content)
+    @message_handler
+    async def handle_output_chunk(self, message: OutputChunk, ctx: MessageContext) -> None:
+        """
+        Collect Executor output as it streams in.
+        """
+        self._executor_output.setdefault(message.run_id, []).append(message)
+        await self._finish_run(message.run_id)
+
+    @message_handler
+    async def handle_executor_failed(self, message: ExecutorFailed, ctx: MessageContext) -> None:
+        """
+        No Executor reply is coming, so drop anything started in anticipation of one.
+        """
+        self._done_pending = False
+        if self._speculation is not None:
+            token, _ = self._speculation
+            self._speculation = None
+            token.cancel()
+
+    @message_handler
+    async def handle_output_end(self, message: OutputEnd, ctx: MessageContext) -> None:
+        """
+        The Executor finished a run; answer it once all of its chunks have arrived.
+        """
+        self._executor_ends[message.run_id] = message
+        await self._finish_run(message.run_id)
+
+    async def _finish_run(self, run_id: int) -> None:
+        """
+        If run `run_id` is complete, coalesce its streamed output into a single
+        'SUCCESS:'/'ERROR:' reply and answer it. Chunks and the end marker may arrive in any order.
+        """
+        end = self._executor_ends.get(run_id)
+        chunks = self._executor_output.get(run_id, [])
+        if end is None or len(chunks) < end.n_chunks:
+            return
+        del self._executor_ends[run_id]
+        self._executor_output.pop(run_id, None)
+        if self._done_pending:
+            self._done_pending = False
+            if end.error is None and end.status == "SUCCESS" and self._task_complete_event is not None:
+                # The code in the final answer ran cleanly, so the task really is done
+                self._task_complete_event.set()
+                return
+        if end.error is not None:
+            content = f"ERROR:\n{end.error}"
+        else:
+            chunks.sort(key=lambda chunk: chunk.seq)
+            content = f"{end.status}:\n" + "".join(chunk.content for chunk in chunks)
+        await self._respond(content)
+
+    async def _respond(self, content: str) -> None:
+        """
+        Append `content` as user context, call the LLM, then publish the LLM response.
+        Does nothing once the task has been reported complete.
+        """
+        if self._task_complete_event is not None and self._task_complete_event.is_set():
+            return
+        self._done_pending = False
+
+        # The message is "user" in a conversation sense
+        self._append_history(UserMessage(content=content, source="user"))
+
+        print("\n================= Assistant says =================")
+        cache_key = self._cache_key(content)
+        cached = self._response_cache.get(cache_key) if cache_key is not None else None
+        speculation = self._take_speculation(content)
+        if cached is not None:
+            # Same conversation as before: replay the stored answer
+            if speculation is not None:
+                speculation.cancel()
+            full = cached
+            print(full)
+            done = _DONE_SENTINEL in full
+        elif speculation is not None:
+            # We guessed this reply while the Executor was running, so the answer is (nearly) ready
+            result = await speculation
+            full = result.content
+            print(full)
+            done = _DONE_SENTINEL in full
+        elif content.startswith("ERROR:"):
+            # Error recovery: race a couple of candidate fixes and keep the first usable one
+            full = await self._race_candidates()
+            print(full)
+            done = _DONE_SENTINEL in full
+        else:
+            # Stream the LLM's text to console as tokens arrive
+            chunks: List[str] = []
+            # Watch for the sentinel as it streams; the tail catches it when split across chunks
+            done = False
+            tail = ""
+            async for chunk in self._model_client.create_stream(self._chat_history):
+                # Deltas are plain strings; the final item is the full CreateResult
+                if isinstance(chunk, str):
+                    chunks.append(chunk)
+                    print(chunk, end="", flush=True)
+                    if not done:
+                        window = tail + chunk
+                        done = _DONE_SENTINEL in window
+                        tail = window[-(len(_DONE_SENTINEL) - 1):]
+            print()
+            full = "".join(chunks)
+
+        if cache_key is not None and cached is None:
+            self._response_cache[cache_key] = full
 
         # Store in chat history
-        self._chat_history.append(AssistantMessage(content=result.content, source="assistant"))
+        self._append_history(AssistantMessage(content=full, source="assistant"))
+
+        if done and self._task_complete_event is not None:
+            if extract_r_code_blocks(full):
+                # Don't trust DONE until the code it came with has actually worked
+                self._done_pending = True
+            else:
+                self._task_complete_event.set()
+
+        # Overlap the next LLM call with the Executor running this code, unless we're finished.
+        # Replayed answers skip this: the next turn is likely a cache hit too.
+        if not done and cached is None and extract_r_code_blocks(full):
+            self._speculate()
 
         # Publish it so the Executor sees it
-        await self.publish_message(Message(result.content), DefaultTopicId())
+        await self.publish_message(Message(full), DefaultTopicId())
+
+    def _append_history(self, message: LLMMessage) -> None:
+        """
+        Append to the chat history, evicting the oldest turns (but never the system prompt)
+        so each request stays roughly the same size however long the session runs.
+        """
+        self._chat_history.append(message)
+        if len(self._chat_history) > self._max_recent_messages + 1:
+            self._chat_history = [self._chat_history[0]] + self._chat_history[-self._max_recent_messages:]
+
+    def _cache_key(self, content: str) -> str | None:
+        """
+        Hash the model name and the chat history as it will be sent to the model.
+        Returns None when the response cache must not be used for this turn.
+        """
+        if self._response_cache is None or content.startswith("ERROR:"):
+            return None
+        payload = json.dumps([self._model_name] + [(m.type, m.content) for m in self._chat_history])
+        key = hashlib.blake2b(payload.encode(), digest_size=32).hexdigest()
+        if key in self._seen_history_keys:
+            # The same window came round again in this session: the loop is repeating itself
+            return None
+        self._seen_history_keys.add(key)
+        return key
+
+    async def _race_candidates(self, n: int = 2) -> str:
+        """
+        Request `n` sampled completions in parallel and return the first one containing R code.
+        The remaining requests are cancelled. If none contains code, the last one to finish is returned.
+        """
+        token = CancellationToken()
+        pending = {
+            asyncio.create_task(
+                self._model_client.create(
+                    self._chat_history,
+                    extra_create_args={"temperature": 0.7},
+                    cancellation_token=token,
+                )
+            )
+            for _ in range(n)
+        }
+        content = None
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    content = task.result().content
+                    if extract_r_code(content):
+                        return content
+        finally:
+            token.cancel()
+        if content is None:
+            raise error
+        return content
+
+    def _speculate(self) -> None:
+        """
+        Start the next completion now, assuming the Executor will reply 'SUCCESS:' with no output.
+        This roughly doubles the number of model requests: one is made for every answer with code,
+        and it is only used when the guess is exactly right (otherwise it is cancelled).
+        """
+        token = CancellationToken()
+        guess = self._chat_history + [UserMessage(content=_SPECULATIVE_REPLY, source="user")]
+        task = asyncio.create_task(self._model_client.create(guess, cancellation_token=token))
+        self._speculation = (token, task)
+
+    def _take_speculation(self, content: str) -> asyncio.Task | None:
+        """
+        Return the speculative completion if it was started for exactly this reply.
+        Otherwise cancel it and return None.
+        """
+        if self._speculation is None:
+            return None
+        token, task = self._speculation
+        self._speculation = None
+        if content == _SPECULATIVE_REPLY:
+            return task
+        token.cancel()
+        return None
 
 ###############################################################################
 # 2) The Executor agent: uses rpy2 to run the R code
 ###############################################################################
-def extract_r_code(full_text: str) -> str | None:
-    """
-    Looks for a single code-fence: ```r ... ```
-    Returns the code inside, or None if not found.
-    """
-    pattern = re.compile(r"```r\s*\n([\s\S]*?)```")
-    match = pattern.search(full_text)
-    if match:
-        return match.group(1)
-    return None
-
 @default_subscription
 class Executor(RoutedAgent):
     """
     This agent extracts R code from the Assistant's message and runs it via rpy2.
-    We capture console output in a custom callback. If there's an R error, we return 'ERROR:\n...'
-    Otherwise 'SUCCESS:\n...'.
+    We capture console output in a custom callback and stream it to the Assistant as OutputChunk
+    messages while R runs, then publish an OutputEnd with status 'ERROR' if there was an R error,
+    otherwise 'SUCCESS'.
+
+    All code fences of one message are evaluated in a single ro.r() call,
+    so each message pays the rpy2 parse/dispatch overhead only once.
     """
     def __init__(self) -> None:
         super().__init__("R Executor Agent")
+        # Tags each run's OutputChunks and OutputEnd so the Assistant never mixes up overlapping runs
+        self._next_run_id = 0
+        # R is not thread-safe, so every call goes through this one worker thread
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Kept so R start-up or setup failures surface on the first run instead of being lost
+        self._setup = self._executor.submit(setup_r_session)
 
     @message_handler
     async def handle_message(self, message: Message, ctx: MessageContext) -> None:
-        code = extract_r_code(message.content)
-        if not code:
+        blocks = extract_r_code_blocks(message.content)
+        if not blocks:
             print("\n--------- Executor: NO R CODE FOUND ---------\n")
             return
 
-        result = self.run_r_code_rpy2(code)
-        print("\n--------- Executor Output ---------\n" + result)
+        code = "\n".join(use_cached_dsc(block) for block in blocks)
+        print("\n--------- Executor Output ---------")
+        try:
+            end = await self.run_r_code_rpy2(code)
+        except Exception as e:
+            # Let the Assistant cancel its speculative completion, then surface the failure
+            await self.publish_message(ExecutorFailed(error=str(e)), DefaultTopicId())
+            raise
+        print(f"\n--------- Executor: {end.status} ---------\n")
 
-        # Publish the result so the Assistant sees it
-        await self.publish_message(Message(result), DefaultTopicId())
+        # Publish the end marker so the Assistant answers the full output
+        await self.publish_message(end, DefaultTopicId())
 
-    def run_r_code_rpy2(self, code: str) -> str:
+    async def run_r_code_rpy2(self, code: str) -> OutputEnd:
         """
-        Evaluate the R code in the *same* R session using rpy2.
-        We'll capture console output by overriding rinterface callbacks.
+        Evaluate the R code on the R worker thread, keeping the event loop free meanwhile.
+        Console output is forwarded to the Assistant as it is produced.
         """
-        output_buffer = []
-
-        # We'll intercept console output by overriding the callbacks in rpy2.rinterface_lib.callbacks
-        from rpy2.rinterface_lib import callbacks
+        # Re-raises here if R failed to start or the setup snippets failed
+        await asyncio.wrap_future(self._setup)
 
-        def console_write_print(x):
-            output_buffer.append(x)
+        run_id = self._next_run_id
+        self._next_run_id += 1
 
-        # Save the original callbacks
-        old_writeconsole = callbacks.consolewrite_print
-        old_warnerror = callbacks.consolewrite_warnerror
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue[str | None] = asyncio.Queue()
+        forwarder = asyncio.create_task(self._forward_stream(queue, run_id))
 
-        # Override with our custom function
-        callbacks.consolewrite_print = console_write_print
-        callbacks.consolewrite_warnerror = console_write_print
+        def write(x: str) -> None:
+            # Called on the R worker thread
+            loop.call_soon_threadsafe(queue.put_nowait, x)
 
         try:
-            ro.r(code)  # Execute the R code
-        except Exception as e:
-            msg = f"ERROR:\n{str(e)}"
-        else:
-            joined = "".join(output_buffer)
-            # Check for any R errors in the captured output
-            if "Error" in joined:
-                msg = f"ERROR:\n{joined}"
-            else:
-                msg = f"SUCCESS:\n{joined}"
+            status, error = await loop.run_in_executor(self._executor, self._run_r_code_sync, code, write)
         finally:
-            # Restore the original callbacks
-            callbacks.consolewrite_print = old_writeconsole
-            callbacks.consolewrite_warnerror = old_warnerror
+            # Every write was scheduled before the result came back, so None really is the end
+            queue.put_nowait(None)
+            n_chunks = await forwarder
+        return OutputEnd(run_id=run_id, n_chunks=n_chunks, status=status, error=error)
+
+    async def _forward_stream(self, queue: "asyncio.Queue[str | None]", run_id: int) -> int:
+        """
+        Print and publish console output from `queue` until None arrives, returning the number
+        of chunks published. Whatever has piled up since the last publish goes out as one
+        OutputChunk, rather than one message per R write.
+        """
+        seq = 0
+        finished = False
+        while not finished:
+            parts = [await queue.get()]
+            while not queue.empty():
+                parts.append(queue.get_nowait())
+            # None is only ever put last
+            if parts[-1] is None:
+                parts.pop()
+                finished = True
+            if parts:
+                text = "".join(parts)
+                print(text, end="", flush=True)
+                await self.publish_message(OutputChunk(run_id=run_id, seq=seq, content=text), DefaultTopicId())
+                seq += 1
+        return seq
+
+    def _run_r_code_sync(self, code: str, write: Callable[[str], None]) -> tuple[str, str | None]:
+        """
+        Evaluate the R code in the *same* R session using rpy2.
+        We'll capture console output by overriding rinterface callbacks and pass it to `write`.
+        Returns the status ('SUCCESS' or 'ERROR') and the exception text if ro.r() raised.
+        """
+        with capture_r_output(write) as warnerror:
+            try:
+                eval_r(code)  # Execute the R code, auto-printing like Rscript
+            except Exception as e:
+                return "ERROR", str(e)
 
-        return msg
+        # Check for any R errors in the captured warning/error output
+        if "Error" in warnerror.getvalue():
+            return "ERROR", None
+        return "SUCCESS", None
 
 
 ###############################################################################
 # 3) A simple loop for human feedback: user can type instructions or corrections
 ###############################################################################
+def open_response_cache() -> shelve.Shelf | None:
+    """
+    Open the on-disk response cache named by the AORTA_AGENT_RESPONSE_CACHE environment
+    variable, or return None (no caching) if it is not set.
+    """
+    path = os.environ.get(_RESPONSE_CACHE_ENV)
+    if not path:
+        return None
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return shelve.open(path)
+
 async def main():
     # logging.basicConfig(level=logging.INFO)
 
@@ -177,44 +496,69 @@ async def main():
     # We'll create a local runtime
     runtime = SingleThreadedAgentRuntime()
 
+    # gpt-4o-mini is fast and cheap enough for this iterative loop.
+    # Built once here so every Assistant instance shares the same connection pool;
+    # HTTP/2 (when the optional 'h2' package is installed) multiplexes concurrent requests.
+    http_client = httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_keepalive_connections=32),
+    )
+    model_name = "gpt-4o-mini"
+    model_client = OpenAIChatCompletionClient(model=model_name, http_client=http_client)
+
+    # Set by the Assistant once it says 'DONE'
+    task_complete_event = asyncio.Event()
+    response_cache = open_response_cache()
+
     # Register the Assistant and Executor
-    # We'll use GPT-3.5 or GPT-4, whichever is accessible
     async def assistant_factory():
         return Assistant(
-            model_client=OpenAIChatCompletionClient(model="gpt-4o")
+            model_client=model_client,
+            task_complete_event=task_complete_event,
+            response_cache=response_cache,
+            model_name=model_name,
         )
 
     async def executor_factory():
         return Executor()
 
-    await Assistant.register(runtime, "assistant", assistant_factory)
-    await Executor.register(runtime, "executor", executor_factory)
-
-    runtime.start()
+    try:
+        await asyncio.gather(
+            Assistant.register(runtime, "assistant", assistant_factory),
+            Executor.register(runtime, "executor", executor_factory),
+        )
 
-    # Start with an initial user request:
-    initial_task = (
-        "Compute mean and std dev from the 'aorta' column in dsc.csv. Then say 'DONE'."
-    )
-    print(f"\n---------- user ----------\n{initial_task}")
-    await runtime.publish_message(Message(initial_task), DefaultTopicId())
-
-    # Now let's allow the user to correct or continue
-    while True:
-        # We'll wait for idle, meaning no pending messages
-        # That means the assistant & executor have responded
-        await runtime.stop_when_idle()
-        # If the assistant's code is all done or you want to continue, let's ask
-        cont = input("\nTEAM is idle. Enter feedback or corrections (empty to exit): ")
-        if not cont.strip():
-            print("\nExiting...\n")
-            break
-        # Otherwise, let's feed that back as user input
-        print(f"\n---------- user ----------\n{cont}")
         runtime.start()
-        await runtime.publish_message(Message(cont), DefaultTopicId())
 
-    await runtime.stop_when_idle()
+        # Start with an initial user request:
+        initial_task = (
+            "Compute mean and std dev from the 'aorta' column in dsc.csv. Then say 'DONE'."
+        )
+        print(f"\n---------- user ----------\n{initial_task}")
+        await runtime.publish_message(Message(initial_task), DefaultTopicId())
+
+        # Now let's allow the user to correct or continue
+        while True:
+            # We'll wait for idle, meaning no pending messages
+            # That means the assistant & executor have responded
+            await runtime.stop_when_idle()
+            if task_complete_event.is_set():
+                print("\n=== TASK COMPLETE ===\n")
+                break
+            # If you want to continue or correct the assistant, let's ask
+            cont = input("\nTEAM is idle. Enter feedback or corrections (empty to exit): ")
+            if not cont.strip():
+                print("\nExiting...\n")
+                break
+            # Otherwise, let's feed that back as user input
+            print(f"\n---------- user ----------\n{cont}")
+            runtime.start()
+            await runtime.publish_message(Message(cont), DefaultTopicId())
+    finally:
+        # Release the HTTP connections and flush the response cache, however we got here
+        await model_client.close()
+        if response_cache is not None:
+            response_cache.close()
     print("\nAll done.\n")
 
 if __name__ == "__main__":
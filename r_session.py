@@ -0,0 +1,140 @@
+import re
+import contextlib
+import functools
+import io
+from typing import Callable, List
+
+###############################################################################
+# Shared helpers for running agent-generated R code in an embedded rpy2 session.
+# Used by both human_in_the_loop_rpy2.py and single_file_agent.py.
+###############################################################################
+
+# Matches a single R code-fence: ```r ... ```
+_R_CODE_RE = re.compile(r"```r\s*\n([\s\S]*?)```")
+
+# Defines .load_dsc() in the R session: dsc.csv is parsed once and re-read only if the file changes.
+# The dot prefix hides it from ls(), so generated `rm(list = ls())` calls leave it in place.
+_DSC_LOADER_R = """
+.load_dsc <- local({
+  cache <- NULL
+  mtime <- NULL
+  function() {
+    current <- file.mtime("dsc.csv")
+    if (is.null(cache) || !identical(current, mtime)) {
+      cache <<- if (requireNamespace("data.table", quietly = TRUE)) {
+        as.data.frame(data.table::fread("dsc.csv"))
+      } else {
+        read.csv("dsc.csv")
+      }
+      mtime <<- current
+    }
+    cache
+  }
+})
+"""
+
+# Loaded once per R session so generated code can use data.table without paying for library()
+_PRELOAD_R = 'if (requireNamespace("data.table", quietly = TRUE)) suppressPackageStartupMessages(library(data.table))'
+
+# Evaluates code the way Rscript does: the value of every top-level expression is auto-printed
+_EVAL_R = "function(code) invisible(source(exprs = parse(text = code), print.eval = TRUE, echo = FALSE))"
+
+# read.csv("dsc.csv") / fread("dsc.csv") calls in generated code are routed through .load_dsc()
+_READ_DSC_RE = re.compile(r"""read\.csv\(\s*['"]dsc\.csv['"]\s*\)""")
+_FREAD_DSC_RE = re.compile(r"""(?:data\.table::)?fread\(\s*['"]dsc\.csv['"]\s*\)""")
+
+# rpy2's console callbacks module, imported by the first capture_r_output() so libR stays unloaded until needed
+_r_callbacks = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_r():
+    """
+    Import rpy2 (and so start the embedded R) on first use rather than at module import,
+    so importing these helpers does not pay for R initialisation.
+    """
+    # rpy2 for direct R evaluation
+    import rpy2.robjects as ro
+    return ro
+
+
+@functools.lru_cache(maxsize=None)
+def _get_eval():
+    """
+    Build the R-side evaluator once per session.
+    """
+    return get_r().r(_EVAL_R)
+
+
+def eval_r(code: str) -> None:
+    """
+    Evaluate R code in the global environment, printing the value of each top-level
+    expression as Rscript would (plain ro.r() evaluates silently).
+    """
+    _get_eval()(code)
+
+
+def setup_r_session() -> None:
+    """
+    Prepare the R session for generated code: attach data.table and define .load_dsc().
+    """
+    ro = get_r()
+    ro.r(_PRELOAD_R)
+    ro.r(_DSC_LOADER_R)
+
+
+def extract_r_code(full_text: str) -> str | None:
+    """
+    Looks for a single code-fence: ```r ... ```
+    Returns the code inside, or None if not found.
+    """
+    match = _R_CODE_RE.search(full_text)
+    return match.group(1) if match else None
+
+
+def extract_r_code_blocks(full_text: str) -> List[str]:
+    """
+    Like extract_r_code, but returns the code of every ```r ... ``` fence, in order.
+    """
+    return _R_CODE_RE.findall(full_text)
+
+
+def use_cached_dsc(code: str) -> str:
+    """
+    Rewrite reads of dsc.csv in R code to use the session's cached copy from .load_dsc().
+    """
+    code = _READ_DSC_RE.sub(".load_dsc()", code)
+    return _FREAD_DSC_RE.sub("data.table::as.data.table(.load_dsc())", code)
+
+
+@contextlib.contextmanager
+def capture_r_output(write: Callable[[str], None]):
+    """
+    Route all R console output to `write` for the duration of the block.
+    Yields a StringIO that additionally collects only R's warning/error stream.
+    """
+    # Only the warning/error stream is searched for R errors, and it is usually empty
+    warnerror = io.StringIO()
+
+    def console_write_warnerror(x):
+        write(x)
+        warnerror.write(x)
+
+    global _r_callbacks
+    if _r_callbacks is None:
+        from rpy2.rinterface_lib import callbacks as _r_callbacks
+    callbacks = _r_callbacks
+
+    # Save the original callbacks
+    old_writeconsole = callbacks.consolewrite_print
+    old_warnerror = callbacks.consolewrite_warnerror
+
+    # Override with our custom functions
+    callbacks.consolewrite_print = write
+    callbacks.consolewrite_warnerror = console_write_warnerror
+    try:
+        yield warnerror
+    finally:
+        # Restore the original callbacks
+        callbacks.consolewrite_print = old_writeconsole
+        callbacks.consolewrite_warnerror = old_warnerror
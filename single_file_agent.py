@@ -1,6 +1,5 @@
 import asyncio
-import tempfile
-import subprocess
+import io
 from typing import Sequence
 
 import os
@@ -15,19 +14,27 @@ from autogen_agentchat.ui import Console
 from autogen_core import CancellationToken
 import logging
 
+# rpy2 helpers for a persistent, in-process R session
+from r_session import capture_r_output, eval_r, extract_r_code, setup_r_session, use_cached_dsc
+
 # logging.basicConfig(level=logging.DEBUG)
 
 
 ###############################################################################
-# 1) Define an RExecutorAgent that runs R code with subprocess.Popen(["Rscript", ...])
+# 1) Define an RExecutorAgent that runs R code in-process with rpy2
 ###############################################################################
 class RExecutorAgent(BaseChatAgent):
     """
     A custom agent that looks for R code in the last message:
       - If we find a code fence like ```r ... ```
-      - we extract the code, run it with Rscript, and return the result (stdout or error).
+      - we extract the code, run it with rpy2, and return the result (console output or error).
+    R state (loaded libraries, data frames) persists between calls.
     """
 
+    def __init__(self, name: str, description: str) -> None:
+        super().__init__(name=name, description=description)
+        setup_r_session()
+
     async def on_messages(
         self, messages: Sequence[ChatMessage], cancellation_token: CancellationToken
     ) -> Response:
@@ -40,13 +47,10 @@ class RExecutorAgent(BaseChatAgent):
             return Response(chat_message=TextMessage(content="(Unsupported message type.)", source=self.name))
 
         text = latest_msg.content
-        # Very naive extraction of R code from a triple-backtick block ```r ... ```
-        code_fence_start = "```r"
-        code_fence_end = "```"
-        if code_fence_start in text and code_fence_end in text:
-            start_idx = text.index(code_fence_start) + len(code_fence_start)
-            end_idx = text.index(code_fence_end, start_idx)
-            r_code = text[start_idx:end_idx].strip()
+        # Extract R code from a triple-backtick block ```r ... ``` in a single pass
+        r_code = extract_r_code(text)
+        if r_code is not None:
+            r_code = use_cached_dsc(r_code.strip())
             # Actually run that R code:
             result = self.run_r_code(r_code)
             return Response(chat_message=TextMessage(content=result, source=self.name))
@@ -54,31 +58,22 @@ class RExecutorAgent(BaseChatAgent):
             return Response(chat_message=TextMessage(content="(No R code found in your message. Start your R code block with ```r and end it with ```)", source=self.name))
 
     def run_r_code(self, code: str) -> str:
-        """Run the given R code in a temp file via Rscript. Return 'ERROR:...' or 'SUCCESS:...'."""
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".R", delete=False) as tmp:
-            tmp.write(code)
-            tmp.flush()
-            tmp_file_name = tmp.name
-
-        try:
-            process = subprocess.Popen(
-                ["Rscript", tmp_file_name],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            stdout, stderr = process.communicate()
-            returncode = process.returncode
-            if returncode != 0 or stderr.strip():
-                # treat any non-zero exit or any stderr as error
-                return f"ERROR:\n{stderr}"
-            else:
-                return f"SUCCESS:\n{stdout}"
-        except Exception as e:
-            return f"ERROR:\nException when running R code:\n{str(e)}"
+        """Run the given R code in the embedded R session via rpy2. Return 'ERROR:...' or 'SUCCESS:...'."""
+        output = io.StringIO()
+        with capture_r_output(output.write) as warnerror:
+            try:
+                eval_r(code)  # Execute the R code, auto-printing like Rscript
+            except Exception as e:
+                return f"ERROR:\n{str(e)}"
+
+        joined = output.getvalue()
+        # Check for any R errors in the captured warning/error output
+        if "Error" in warnerror.getvalue():
+            return f"ERROR:\n{joined}"
+        return f"SUCCESS:\n{joined}"
 
     async def on_reset(self, cancellation_token: CancellationToken) -> None:
-        # no internal state
+        # R session state is kept on purpose so the coder can build on earlier steps
         pass
 
     @property
@@ -115,6 +110,7 @@ class RCoderAgent(AssistantAgent):
             "3. The RExecutor will only run code inside ```r ... ```. If there's no code block, it won't run.\n"
             "4. If you get an ERROR, refine the code and try again.\n"
             "5. Once both tasks succeed, produce a plain text summary and say 'DONE'.\n"
+            "6. Prefer `data.table::fread` over `read.csv`. Compute all summary stats in a single `print(dt[, .(...)])` expression to avoid multiple passes over the same column.\n"
         )
 
 